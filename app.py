@@ -1,8 +1,20 @@
 import streamlit as st  # UI Framework
-from snowflake.snowpark.context import get_active_session  # Snowpark Session Management
 from snowflake.cortex import Complete  # Direct Cortex LLM API
-import pandas as pd  # Data Manipulation
 import json  # JSON Parsing
+import logging  # Server-Side Diagnostics
+import re  # Question Number Matching
+import time  # Semantic Cache Expiry
+import threading  # Semantic Cache Locking
+from concurrent.futures import ThreadPoolExecutor  # Background Document Links
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx  # Streamlit Context for Worker Threads
+import numpy as np  # Embedding Vectors
+import faiss  # Approximate Nearest-Neighbour Index
+
+from common.snowflake import get_session, run_query  # Shared Snowpark Session
+from common import retrieval  # Shared Cortex Search Retrieval
+from common.cortex import cortex_complete  # Memoized Cortex Completion
+
+logger = logging.getLogger(__name__)
 
 # -------------------------
 # Initialize Session State Defaults
@@ -10,8 +22,8 @@ import json  # JSON Parsing
 st.session_state.setdefault('model_name', 'mistral-large2')
 st.session_state.setdefault('category_value', 'ALL')
 st.session_state.setdefault('use_context', False)
-st.session_state.setdefault('chat_history', [])
 st.session_state.setdefault('slide_window', 5)  # Number of messages to keep in the window
+st.session_state.setdefault('chat_history', [])
 
 # -------------------------
 # Page Configuration
@@ -25,11 +37,15 @@ st.set_page_config(
 # Snowflake Connection
 # -------------------------
 # Establish Snowflake session
-session = get_active_session()
+session = get_session()
+retrieval.prewarm_categories()
 
 # -------------------------
 # Sidebar Configuration
 # -------------------------
+MODELS = ('mistral-large2', 'mistral-large', 'mistral-7b')
+MODEL_IDX = {model: i for i, model in enumerate(MODELS)}
+
 def config_options():
     st.sidebar.title("Configuration")
     
@@ -37,18 +53,15 @@ def config_options():
     st.sidebar.subheader("Model Selection")
     selected_model = st.sidebar.selectbox(
         'Choose your model:',
-        ['mistral-large2', 'mistral-large', 'mistral-7b'],
-        index=['mistral-large2', 'mistral-large', 'mistral-7b'].index(st.session_state.model_name)
+        MODELS,
+        index=MODEL_IDX.get(st.session_state.model_name, 0)
     )
     st.session_state.model_name = selected_model
     
     # Category Filter
     st.sidebar.subheader("Category Filter")
     try:
-        categories = session.sql(
-            "SELECT DISTINCT category FROM IRS_PUBS_CORTEX_SEARCH_DOCS.DATA.DOCS_CHUNKS_TABLE"
-        ).collect()
-        cat_list = ['ALL'] + [cat['CATEGORY'] for cat in categories]
+        cat_list = ['ALL'] + retrieval.load_categories()
     except Exception as e:
         st.sidebar.error(f"Failed to load categories: {e}")
         cat_list = ['ALL']
@@ -73,9 +86,11 @@ def config_options():
 # -------------------------
 def get_chat_history():
     """
-    Returns the last N messages from the chat history.
+    Returns the most recent messages within the slide window, starting on a user message
+    so the summarizer never sees an answer without its question.
     """
     start_index = max(0, len(st.session_state.chat_history) - st.session_state.slide_window)
+    start_index += start_index % 2  # Turns are stored as user/assistant pairs
     return st.session_state.chat_history[start_index:]
 
 def summarize_question_with_history(chat_history, question):
@@ -88,7 +103,7 @@ def summarize_question_with_history(chat_history, question):
     QUESTION: {question}
     """
     try:
-        summary = Complete(model=st.session_state.model_name, prompt=prompt)
+        summary = cortex_complete(st.session_state.model_name, prompt)
         return summary
     except Exception as e:
         st.error(f"Failed to summarize question with history: {e}")
@@ -99,35 +114,63 @@ def summarize_question_with_history(chat_history, question):
 # -------------------------
 def get_similar_chunks_search_service(query):
     """
-    Retrieve similar chunks from IRS_PUBS_CORTEX_SEARCH_DOCS.
+    Retrieve the chunks most similar to the query from the Cortex Search Service.
     """
     try:
-        if st.session_state.category_value == "ALL":
-            response = session.sql(f"""
-                SELECT * 
-                FROM IRS_PUBS_CORTEX_SEARCH_DOCS.DATA.DOCS_CHUNKS_TABLE 
-                LIMIT 3
-            """).collect()
-        else:
-            response = session.sql(f"""
-                SELECT * 
-                FROM IRS_PUBS_CORTEX_SEARCH_DOCS.DATA.DOCS_CHUNKS_TABLE 
-                WHERE category = '{st.session_state.category_value}'
-                LIMIT 3
-            """).collect()
-        
-        return response
+        return retrieval.get_similar_chunks(query, st.session_state.category_value)
     except Exception as e:
         st.error(f"Failed to retrieve similar chunks: {e}")
         return []
 
+def get_presigned_urls(relative_paths):
+    """
+    Returns a presigned URL for each document path, generated in a single query.
+    """
+    try:
+        return retrieval.get_presigned_urls(relative_paths)
+    except Exception as e:
+        st.error(f"Failed to generate document links: {e}")
+        return {}
+
 # -------------------------
 # Prompt Creation
 # -------------------------
+# The invariant instructions lead the prompt so consecutive prompts share a byte-identical
+# prefix the LLM server can reuse; only the context and question vary at the tail.
+CONTEXT_PROMPT = """You are an expert IRS tax assistant with a deep understanding of IRS guidelines and general U.S. tax laws.
+
+INSTRUCTIONS:
+- Provide clear, concise, and authoritative answers.
+- Do not invent information.
+- If relevant, recommend IRS forms or publications.
+- If context is insufficient, fall back on your expert knowledge.
+
+CONTEXT:
+{ctx}
+
+QUESTION:
+{q}
+"""
+
+NO_CONTEXT_PROMPT = """You are an expert IRS tax assistant with a deep understanding of IRS guidelines and general U.S. tax laws.
+
+INSTRUCTIONS:
+- Provide clear, concise, and authoritative answers.
+- Do not invent information.
+- If relevant, recommend IRS forms or publications.
+
+QUESTION:
+{q}
+"""
+
 def create_prompt(question):
     """
     Creates the final LLM prompt using history, context, and the question.
+    Context is only retrieved when document context is enabled.
     """
+    if not st.session_state.use_context:
+        return NO_CONTEXT_PROMPT.format(q=question), []
+
     chat_history = get_chat_history()
     
     if chat_history:
@@ -136,40 +179,198 @@ def create_prompt(question):
     else:
         context_chunks = get_similar_chunks_search_service(question)
     
-    prompt_context = "\n\n".join([row.CHUNK for row in context_chunks])
-    relative_paths = set(row.RELATIVE_PATH for row in context_chunks)
+    prompt_context = "\n\n".join(row["chunk"] for row in context_chunks)
+    relative_paths = list(dict.fromkeys(row["relative_path"] for row in context_chunks))
     
-    prompt = f"""
-    You are an expert IRS tax assistant with a deep understanding of IRS guidelines and general U.S. tax laws.
-    
-    CONTEXT:
-    {prompt_context}
+    prompt = CONTEXT_PROMPT.format(ctx=prompt_context, q=question)
+    return prompt, relative_paths
 
-    QUESTION:
-    {question}
+# -------------------------
+# Semantic Cache
+# -------------------------
+EMBEDDING_MODEL = "e5-base-v2"
+EMBEDDING_DIM = 768
+EMBEDDING_PREFIX = "query: "  # e5 models expect queries to carry this prefix
+SEMANTIC_CACHE_THRESHOLD = 0.92  # Minimum cosine similarity for a cache hit
+SEMANTIC_CACHE_NEIGHBOURS = 4  # Candidates checked per lookup, so expired entries do not shadow fresh ones
+SEMANTIC_CACHE_TTL = 24 * 3600  # Seconds an answer is served from the cache
+SEMANTIC_CACHE_TABLE = "IRS_PUBS_CORTEX_SEARCH_DOCS.DATA.SEMCACHE"
+# Bump whenever CONTEXT_PROMPT, NO_CONTEXT_PROMPT or the embedding input changes, so answers
+# produced by the old templates are no longer served
+PROMPT_TEMPLATE_VERSION = 1
 
-    INSTRUCTIONS:
-    - Provide clear, concise, and authoritative answers.
-    - Do not invent information.
-    - If relevant, recommend IRS forms or publications.
-    - If context is insufficient, fall back on your expert knowledge.
+def question_numbers(question):
     """
-    return prompt, relative_paths
+    Returns the numbers in a question. Embeddings barely separate "2023" from "2024",
+    so a cached answer is only reused when these match exactly.
+    """
+    return sorted(re.findall(r"\d+", question))
+
+class SemanticCache:
+    """
+    HNSW index of previously answered questions, persisted to the SEMCACHE table.
+    Each instance holds the unexpired answers for one (model, category, use_context, template) scope.
+    """
+    def __init__(self, model_name, category_value, use_context):
+        self.scope = [model_name, category_value, use_context, PROMPT_TEMPLATE_VERSION]
+        # 8-bit scalar quantization stores each vector in a quarter of the fp32 size.
+        # Normalized embeddings lie within [-1, 1], so the quantizer is trained on that range.
+        self.index = faiss.IndexHNSWSQ(
+            EMBEDDING_DIM, faiss.ScalarQuantizer.QT_8bit, 32, faiss.METRIC_INNER_PRODUCT
+        )
+        self.index.train(np.array([[-1.0] * EMBEDDING_DIM, [1.0] * EMBEDDING_DIM], dtype="float32"))
+        self.entries = []
+        self.lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        run_query(f"""
+            CREATE TABLE IF NOT EXISTS {SEMANTIC_CACHE_TABLE} (
+                model_name STRING,
+                category STRING,
+                use_context BOOLEAN,
+                question STRING,
+                answer STRING,
+                relative_paths ARRAY,
+                embedding ARRAY,
+                prompt_version NUMBER,
+                expires_at TIMESTAMP_LTZ
+            )
+        """)
+        rows = run_query(f"""
+            SELECT question, answer, relative_paths, embedding,
+                DATE_PART(epoch_second, expires_at) AS expires_at
+            FROM {SEMANTIC_CACHE_TABLE}
+            WHERE model_name = ? AND category = ? AND use_context = ? AND prompt_version = ?
+                AND expires_at > CURRENT_TIMESTAMP()
+        """, params=self.scope)
+        if rows:
+            self.index.add(np.array([json.loads(row.EMBEDDING) for row in rows], dtype="float32"))
+            self.entries = [
+                (row.QUESTION, row.ANSWER, json.loads(row.RELATIVE_PATHS), row.EXPIRES_AT)
+                for row in rows
+            ]
+
+    def lookup(self, vector, question):
+        """
+        Returns the cached (question, answer, relative_paths) closest to the vector, if it is
+        similar enough, unexpired, and mentions the same numbers as the question.
+        """
+        numbers = question_numbers(question)
+        now = time.time()
+        with self.lock:
+            if self.index.ntotal == 0:
+                return None
+            similarities, ids = self.index.search(vector, SEMANTIC_CACHE_NEIGHBOURS)
+            for similarity, i in zip(similarities[0], ids[0]):
+                if i < 0 or similarity < SEMANTIC_CACHE_THRESHOLD:
+                    break
+                cached_question, answer, relative_paths, expires_at = self.entries[i]
+                if expires_at > now and question_numbers(cached_question) == numbers:
+                    return cached_question, answer, relative_paths
+            return None
+
+    def add(self, vector, question, answer, relative_paths):
+        """
+        Adds an answered question to the index and persists it for other sessions.
+        """
+        relative_paths = list(relative_paths)
+        with self.lock:
+            self.index.add(vector)
+            self.entries.append((question, answer, relative_paths, time.time() + SEMANTIC_CACHE_TTL))
+        run_query(f"""
+            INSERT INTO {SEMANTIC_CACHE_TABLE} (
+                model_name, category, use_context, prompt_version,
+                question, answer, relative_paths, embedding, expires_at
+            )
+            SELECT ?, ?, ?, ?, ?, ?, PARSE_JSON(?)::ARRAY, PARSE_JSON(?)::ARRAY,
+                DATEADD(second, ?, CURRENT_TIMESTAMP())
+        """, params=self.scope + [
+            question, answer, json.dumps(relative_paths), json.dumps(vector[0].tolist()),
+            SEMANTIC_CACHE_TTL
+        ])
+
+@st.cache_resource
+def get_semantic_cache(model_name, category_value, use_context):
+    """
+    Returns the semantic cache for the scope, or None if it cannot be set up (for example
+    when the role may not create the SEMCACHE table). The None is cached too, so the DDL
+    is not retried and end users see no error; the app simply answers without the cache.
+    """
+    try:
+        return SemanticCache(model_name, category_value, use_context)
+    except Exception:
+        logger.warning(
+            "Semantic cache disabled for %s/%s/%s", model_name, category_value, use_context,
+            exc_info=True
+        )
+        return None
+
+def embed_question(question):
+    """
+    Embeds the question with Cortex, normalized so inner product equals cosine similarity.
+    """
+    rows = run_query(
+        "SELECT SNOWFLAKE.CORTEX.EMBED_TEXT_768(?, ?) AS embedding",
+        params=[EMBEDDING_MODEL, EMBEDDING_PREFIX + question]
+    )
+    vector = np.array([rows[0]["EMBEDDING"]], dtype="float32")
+    faiss.normalize_L2(vector)
+    return vector
 
 # -------------------------
 # Answer Generation
 # -------------------------
-def answer_question(question):
+def stream_response(prompt, on_complete=None):
     """
-    Generate a response from the LLM.
+    Yields the LLM response as it is generated, then passes the full text to on_complete.
     """
-    prompt, relative_paths = create_prompt(question)
+    response = ""
     try:
-        response = Complete(model=st.session_state.model_name, prompt=prompt)
-        return response, relative_paths
+        for chunk in Complete(model=st.session_state.model_name, prompt=prompt, session=session, stream=True):
+            response += chunk
+            yield chunk
     except Exception as e:
         st.error(f"Failed to generate response: {e}")
-        return "Sorry, there was an error processing your question.", []
+        yield "Sorry, there was an error processing your question."
+        return
+    if on_complete is not None:
+        on_complete(response)
+
+def answer_question(question):
+    """
+    Generate a streamed response from the LLM, reusing the answer to a semantically similar question if cached.
+    Returns an iterator over the response text and the related document paths.
+    """
+    # Follow-up questions depend on the conversation, so only opening questions use the cache
+    semantic_cache, vector = None, None
+    if not st.session_state.chat_history:
+        try:
+            semantic_cache = get_semantic_cache(
+                st.session_state.model_name,
+                st.session_state.category_value,
+                st.session_state.use_context
+            )
+            if semantic_cache is not None:
+                vector = embed_question(question)
+                cached = semantic_cache.lookup(vector, question)
+                if cached:
+                    _, response, relative_paths = cached
+                    return iter([response]), relative_paths
+        except Exception as e:
+            st.error(f"Failed to query semantic cache: {e}")
+            semantic_cache = None
+
+    prompt, relative_paths = create_prompt(question)
+
+    def update_semantic_cache(response):
+        try:
+            semantic_cache.add(vector, question, response, relative_paths)
+        except Exception as e:
+            st.error(f"Failed to update semantic cache: {e}")
+
+    on_complete = update_semantic_cache if semantic_cache is not None else None
+    return stream_response(prompt, on_complete), relative_paths
 
 # -------------------------
 # Main App
@@ -187,22 +388,41 @@ def main():
     
     # User Input
     if question := st.chat_input("What do you want to know about IRS guidelines?"):
-        st.session_state.chat_history.append({"role": "user", "content": question})
-        
         with st.chat_message("user"):
             st.markdown(question)
         
         with st.chat_message("assistant"):
             message_placeholder = st.empty()
             with st.spinner("Thinking..."):
-                response, relative_paths = answer_question(question)
+                response_stream, relative_paths = answer_question(question)
+
+            # Sign the document links in the background while the answer streams, so the
+            # round trips overlap; the semantic cache INSERT that runs when the stream ends
+            # waits for the URL query through run_query instead of sharing the cursor with it
+            with ThreadPoolExecutor(
+                max_workers=1,
+                initializer=add_script_run_ctx,
+                initargs=(None, get_script_run_ctx())
+            ) as executor:
+                future_urls = executor.submit(get_presigned_urls, relative_paths)
+
+                # Render tokens as they arrive instead of waiting for the full answer
+                response = ""
+                for chunk in response_stream:
+                    response += chunk
+                    message_placeholder.markdown(response + "▌")
                 message_placeholder.markdown(response)
-                
-                if relative_paths:
-                    with st.sidebar.expander("Related Documents"):
-                        for path in relative_paths:
-                            st.sidebar.markdown(f"📄 [Document Link: {path}](#)")
+
+                document_urls = future_urls.result()
+
+            if relative_paths:
+                with st.sidebar.expander("Related Documents"):
+                    for path in relative_paths:
+                        st.sidebar.markdown(f"📄 [Document Link: {path}]({document_urls.get(path, '#')})")
         
+        # Record the turn only after answering, so the history used to build the
+        # prompt holds prior turns and does not repeat the current question
+        st.session_state.chat_history.append({"role": "user", "content": question})
         st.session_state.chat_history.append({"role": "assistant", "content": response})
 
 # -------------------------
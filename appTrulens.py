@@ -1,12 +1,17 @@
 import streamlit as st
-from snowflake.snowpark import Session
 from trulens.core import TruSession
 from trulens.connectors.snowflake import SnowflakeConnector
 from trulens.apps.custom import instrument, TruCustomApp
 from trulens.providers.cortex.provider import Cortex
 from trulens.core import Feedback, Select
-from trulens.core import Tru
 import numpy as np
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+from common.snowflake import get_session
+from common import retrieval
+from common.cortex import cortex_complete
 
 # -------------------------
 # Initialize Session State Defaults
@@ -26,30 +31,27 @@ st.set_page_config(
 # -------------------------
 # Snowflake Connection
 # -------------------------
-@st.cache_resource
-def get_session():
-    return Session.builder.configs({
-        "account": st.secrets["snowflake"]["account"],
-        "user": st.secrets["snowflake"]["user"],
-        "password": st.secrets["snowflake"]["password"],
-        "warehouse": st.secrets["snowflake"]["warehouse"],
-        "database": st.secrets["snowflake"]["database"],
-        "schema": st.secrets["snowflake"]["schema"],
-        "role": st.secrets["snowflake"]["role"]
-    }).create()
-
 session = get_session()
+retrieval.prewarm_categories()
 
 # -------------------------
 # TruLens Integration 
 # -------------------------
-tru_snowflake_connector = SnowflakeConnector(snowpark_session=session)
-tru_session = TruSession(connector=tru_snowflake_connector)
-tru_session.migrate_database()
+@st.cache_resource
+def get_tru_session():
+    tru_snowflake_connector = SnowflakeConnector(snowpark_session=session)
+    tru_session = TruSession(connector=tru_snowflake_connector)
+    tru_session.migrate_database()
+    return tru_session
 
 # -------------------------
 # Sidebar Configuration
 # -------------------------
+MODELS = ('mistral-large2', 'mistral-large', 'mistral-7b')
+MODEL_IDX = {model: i for i, model in enumerate(MODELS)}
+DATA_SOURCES = ("IRS Data Only", "W-2 Data Only", "Both")
+DATA_SOURCE_IDX = {source: i for i, source in enumerate(DATA_SOURCES)}
+
 def config_options():
     st.sidebar.title("Configuration")
     
@@ -59,8 +61,8 @@ def config_options():
         st.session_state.model_name = 'mistral-large2'
     selected_model = st.sidebar.selectbox(
         'Choose your model:',
-        ['mistral-large2', 'mistral-large', 'mistral-7b'],
-        index=['mistral-large2', 'mistral-large', 'mistral-7b'].index(st.session_state.model_name)
+        MODELS,
+        index=MODEL_IDX.get(st.session_state.model_name, 0)
     )
     st.session_state.model_name = selected_model
     
@@ -69,10 +71,7 @@ def config_options():
     if "category_value" not in st.session_state:
         st.session_state.category_value = 'ALL'
     try:
-        categories = session.sql(
-            "SELECT DISTINCT category FROM IRS_PUBS_CORTEX_SEARCH_DOCS.DATA.DOCS_CHUNKS_TABLE"
-        ).collect()
-        cat_list = ['ALL'] + [cat.CATEGORY for cat in categories]
+        cat_list = ['ALL'] + retrieval.load_categories()
     except Exception as e:
         st.sidebar.error(f"Failed to load categories: {e}")
         cat_list = ['ALL']
@@ -99,14 +98,15 @@ def config_options():
         st.session_state.data_source = "IRS Data Only"
     selected_data_source = st.sidebar.radio(
         "Choose Data Source:",
-        ["IRS Data Only", "W-2 Data Only", "Both"],
-        index=["IRS Data Only", "W-2 Data Only", "Both"].index(st.session_state.data_source)
+        DATA_SOURCES,
+        index=DATA_SOURCE_IDX.get(st.session_state.data_source, 0)
     )
     st.session_state.data_source = selected_data_source
 
-    # Testing Toggle
+    # Automated Testing
     st.sidebar.subheader("Testing")
-    st.session_state.run_tests = st.sidebar.checkbox("Run Automated Tests")
+    # A button rather than a checkbox, so the sweep runs once per click and not on every rerun
+    st.session_state.run_tests = st.sidebar.button("Run Automated Tests")
 
 
 
@@ -114,36 +114,64 @@ def config_options():
 # Cortex Search Retriever Class
 # -------------------------
 class CortexSearchRetriever:
-    def __init__(self, session, limit_to_retrieve=3):
-        self.session = session
+    def __init__(self, limit_to_retrieve=retrieval.NUM_CHUNKS):
         self.limit_to_retrieve = limit_to_retrieve
 
     def retrieve(self, query, category_value):
-        if category_value == "ALL":
-            response = self.session.sql(f"""
-                SELECT * 
-                FROM IRS_PUBS_CORTEX_SEARCH_DOCS.DATA.DOCS_CHUNKS_TABLE 
-                LIMIT {self.limit_to_retrieve}
-            """).collect()
-        else:
-            response = self.session.sql(f"""
-                SELECT * 
-                FROM IRS_PUBS_CORTEX_SEARCH_DOCS.DATA.DOCS_CHUNKS_TABLE 
-                WHERE category = '{category_value}' 
-                LIMIT {self.limit_to_retrieve}
-            """).collect()
-        return response
+        return retrieval.get_similar_chunks(query, category_value, self.limit_to_retrieve)
+
+    def prefetch(self, queries, category_value):
+        """
+        Batch-retrieve context for queries in one statement; returns {query: chunks}.
+        """
+        return retrieval.batch_get_similar_chunks(queries, category_value, self.limit_to_retrieve)
+
+# -------------------------
+# Prompt Templates
+# -------------------------
+# Fixed instructions first, per-question context and query appended last.
+CONTEXT_PROMPT = """You are an expert IRS tax assistant with a deep understanding of IRS guidelines and general U.S. tax laws.
+
+Below is CONTEXT extracted from IRS documents. Use it to assist in answering the QUESTION.
+If the context does not fully answer the question, rely on your general knowledge of U.S. tax regulations.
+
+INSTRUCTIONS:
+- Provide clear, concise, and authoritative answers.
+- Do not invent information.
+- If relevant, recommend IRS forms or publications.
+- If context is insufficient, fall back on your expert knowledge of the IRS taxation system.
+- If the nationality is Canadian, research the CRA website and the IRS website to provide a response.
+
+CONTEXT:
+{ctx}
+
+QUESTION:
+{q}
+
+Answer:"""
+
+NO_CONTEXT_PROMPT = """You are an expert IRS tax assistant with a deep understanding of IRS guidelines and general U.S. tax laws.
+
+INSTRUCTIONS:
+- Provide clear, concise, and authoritative answers.
+- If relevant, recommend IRS forms or publications.
+
+QUESTION:
+{q}
+
+Answer:"""
 
 # -------------------------
 # IRS RAG Class
 # -------------------------
 class IRS_RAG:
-    def __init__(self, retriever, session):
+    def __init__(self, retriever):
         self.retriever = retriever
-        self.session = session
 
     @instrument
-    def retrieve_context(self, query: str):
+    def retrieve_context(self, query: str, prefetched: list = None):
+        if prefetched is not None:
+            return prefetched
         category_value = st.session_state.get("category_value", "ALL")
         return self.retriever.retrieve(query, category_value)
 
@@ -160,84 +188,64 @@ class IRS_RAG:
             str: The LLM-generated response.
         """
         if context_response:
-            prompt_context = "\n\n".join([row.CHUNK for row in context_response])
-            prompt = f"""
-            You are an expert IRS tax assistant with a deep understanding of IRS guidelines and general U.S. tax laws.
-            
-            Below is CONTEXT extracted from IRS documents. Use it to assist in answering the QUESTION. 
-            If the context does not fully answer the question, rely on your general knowledge of U.S. tax regulations.
-
-            CONTEXT:
-            {prompt_context}
-
-            QUESTION:
-            {query}
-
-            INSTRUCTIONS:
-            - Provide clear, concise, and authoritative answers.
-            - Do not invent information.
-            - If relevant, recommend IRS forms or publications.
-            - If context is insufficient, fall back on your expert knowledge of the IRS taxation system.
-            - If the nationality is Canadian, research the CRA website and the IRS website to provide a response.
-
-            Answer:
-            """
+            prompt_context = "\n\n".join(row["chunk"] for row in context_response)
+            prompt = CONTEXT_PROMPT.format(ctx=prompt_context, q=query)
         else:
-            prompt = f"""
-            You are an expert IRS tax assistant with a deep understanding of IRS guidelines and general U.S. tax laws.
-
-            QUESTION:
-            {query}
-
-            INSTRUCTIONS:
-            - Provide clear, concise, and authoritative answers.
-            - If relevant, recommend IRS forms or publications.
-
-            Answer:
-            """
+            prompt = NO_CONTEXT_PROMPT.format(q=query)
         try:
-            cmd = "SELECT snowflake.cortex.complete(?, ?) AS response"
-            df_response = self.session.sql(cmd, params=[st.session_state.model_name, prompt]).collect()
-            return df_response[0]['RESPONSE']
+            return cortex_complete(st.session_state.model_name, prompt)
         except Exception as e:
             st.error(f"Failed to generate a response: {e}")
             return "Sorry, there was an error processing your question."
 
     @instrument
-    def query(self, query: str) -> str:
+    def query(self, query: str, prefetched: list = None) -> str:
         """
         Execute the full RAG pipeline: Retrieve context, create a prompt, and generate a response.
 
         Args:
             query (str): The user's question/query.
+            prefetched (list): Context already retrieved for this query, if any.
 
         Returns:
             str: The final response generated by the LLM.
         """
-        context_response = self.retrieve_context(query)
+        if st.session_state.get("use_context", False):
+            context_response = self.retrieve_context(query, prefetched)
+        else:
+            context_response = []
         return self.generate_completion(query, context_response)
 
 # -------------------------
 # Initialize RAG
 # -------------------------
-retriever = CortexSearchRetriever(session)
-rag = IRS_RAG(retriever, session)
+@st.cache_resource
+def get_rag():
+    retriever = CortexSearchRetriever()
+    return IRS_RAG(retriever)
 
 # -------------------------
 # Feedback Functions
 # -------------------------
-provider = Cortex(session, "mistral-large")
-
-f_groundedness = Feedback(provider.groundedness_measure_with_cot_reasons, name="Groundedness").on_output()
-f_context_relevance = Feedback(provider.context_relevance, name="Context Relevance").on_input().on_output().aggregate(np.mean)
-f_answer_relevance = Feedback(provider.relevance, name="Answer Relevance").on_input().on_output().aggregate(np.mean)
+@st.cache_resource
+def get_provider():
+    return Cortex(session, "mistral-large")
 
-tru_rag = TruCustomApp(
-    app=rag,
-    app_name="IRS_RAG_App",
-    app_version="v1.0",
-    feedbacks=[f_groundedness, f_context_relevance, f_answer_relevance]
-)
+@st.cache_resource
+def get_tru_rag():
+    get_tru_session()  # TruCustomApp records into the TruSession singleton
+    provider = get_provider()
+
+    f_groundedness = Feedback(provider.groundedness_measure_with_cot_reasons, name="Groundedness").on_output()
+    f_context_relevance = Feedback(provider.context_relevance, name="Context Relevance").on_input().on_output().aggregate(np.mean)
+    f_answer_relevance = Feedback(provider.relevance, name="Answer Relevance").on_input().on_output().aggregate(np.mean)
+
+    return TruCustomApp(
+        app=get_rag(),
+        app_name="IRS_RAG_App",
+        app_version="v1.0",
+        feedbacks=[f_groundedness, f_context_relevance, f_answer_relevance]
+    )
 
 # -------------------------
 # TruLens Testing Prompts
@@ -265,21 +273,49 @@ TEST_PROMPTS = [
 # -------------------------
 # TruLens Automated Testing
 # -------------------------
-def run_tests():
+def run_tests(rag, tru_rag):
     st.write("### Running Automated Tests with TruLens")
+    prefetched = {}
+    if st.session_state.get("use_context", False):
+        try:
+            prefetched = rag.retriever.prefetch(TEST_PROMPTS, st.session_state.get("category_value", "ALL"))
+        except Exception as e:
+            st.error(f"Failed to prefetch context for test prompts: {e}")
+
     with tru_rag as recording:
-        for prompt in TEST_PROMPTS:
-            try:
-                response = rag.query(prompt)
-                st.write(f"**Question:** {prompt}")
-                st.write(f"**Response:** {response}")
-            except Exception as e:
-                st.error(f"Failed to process prompt: {prompt}. Error: {e}")
-    
-    # Display TruLens Leaderboard
-    st.write("### TruLens Leaderboard")
-    leaderboard = tru_session.get_leaderboard()
-    st.dataframe(leaderboard)
+        # Fan the prompts out so retrieval and TruLens bookkeeping overlap; statements on the
+        # shared session are serialized by run_query. Each worker gets the Streamlit script
+        # context, and each call runs in a copy of the current contextvars so TruLens
+        # attributes it to this recording.
+        with ThreadPoolExecutor(
+            max_workers=8,
+            initializer=add_script_run_ctx,
+            initargs=(None, get_script_run_ctx())
+        ) as executor:
+            futures = {
+                executor.submit(
+                    contextvars.copy_context().run, rag.query, prompt, prefetched.get(prompt)
+                ): prompt
+                for prompt in TEST_PROMPTS
+            }
+            for future in as_completed(futures):
+                prompt = futures[future]
+                try:
+                    response = future.result()
+                    st.write(f"**Question:** {prompt}")
+                    st.write(f"**Response:** {response}")
+                except Exception as e:
+                    st.error(f"Failed to process prompt: {prompt}. Error: {e}")
+
+def show_leaderboard():
+    """
+    Displays the TruLens leaderboard, loaded only on request rather than on every rerun.
+    """
+    with st.expander("TruLens Leaderboard", expanded=False):
+        if st.button("Refresh Leaderboard"):
+            st.session_state.leaderboard = get_tru_session().get_leaderboard()
+        if "leaderboard" in st.session_state:
+            st.dataframe(st.session_state.leaderboard)
 
 # -------------------------
 # Main App
@@ -291,10 +327,12 @@ def main():
 
     
     config_options()
+    rag = get_rag()
+    show_leaderboard()
 
     # Check if user enabled Automated Testing
     if st.session_state.get("run_tests", False):
-        run_tests()
+        run_tests(rag, get_tru_rag())
         return
 
     
@@ -0,0 +1,15 @@
+import streamlit as st
+
+from common.snowflake import run_query
+
+# -------------------------
+# Cortex Completion
+# -------------------------
+@st.cache_data(ttl=3600, show_spinner=False)
+def cortex_complete(model_name, prompt):
+    """
+    Returns the full Cortex completion, memoized for an hour on (model_name, prompt).
+    """
+    cmd = "SELECT snowflake.cortex.complete(?, ?) AS response"
+    df_response = run_query(cmd, params=[model_name, prompt])
+    return df_response[0]['RESPONSE']
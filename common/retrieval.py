@@ -0,0 +1,141 @@
+import streamlit as st
+from snowflake.core import Root
+from concurrent.futures import ThreadPoolExecutor
+import json
+
+from common.snowflake import get_session, run_query
+
+# -------------------------
+# Cortex Search Service
+# -------------------------
+CORTEX_SEARCH_DATABASE = "IRS_PUBS_CORTEX_SEARCH_DOCS"
+CORTEX_SEARCH_SCHEMA = "DATA"
+CORTEX_SEARCH_SERVICE = "IRS_PUBS_SEARCH"
+CORTEX_SEARCH_SERVICE_NAME = f"{CORTEX_SEARCH_DATABASE}.{CORTEX_SEARCH_SCHEMA}.{CORTEX_SEARCH_SERVICE}"
+COLUMNS = ["chunk", "relative_path", "category"]
+NUM_CHUNKS = 3  # Number of chunks to retrieve per question
+DOCS_CHUNKS_TABLE = "IRS_PUBS_CORTEX_SEARCH_DOCS.DATA.DOCS_CHUNKS_TABLE"
+DOCS_STAGE = "@IRS_PUBS_CORTEX_SEARCH_DOCS.DATA.DOCS"
+PRESIGNED_URL_EXPIRY = 3600  # Seconds; outlives the 10 minute URL cache below
+
+@st.cache_resource
+def get_search_service():
+    return (
+        Root(get_session())
+        .databases[CORTEX_SEARCH_DATABASE]
+        .schemas[CORTEX_SEARCH_SCHEMA]
+        .cortex_search_services[CORTEX_SEARCH_SERVICE]
+    )
+
+# -------------------------
+# Categories
+# -------------------------
+def get_categories():
+    """
+    Returns the distinct document categories.
+    """
+    categories = run_query(f"SELECT DISTINCT category FROM {DOCS_CHUNKS_TABLE}")
+    return [cat.CATEGORY for cat in categories]
+
+@st.cache_resource(ttl=600)
+def prewarm_categories():
+    """
+    Starts loading the category list in a background thread when the worker first renders.
+    The returned Future holds the list for 10 minutes, after which the next render reloads it.
+    """
+    executor = ThreadPoolExecutor(max_workers=1)
+    future = executor.submit(get_categories)
+    executor.shutdown(wait=False)
+    return future
+
+def load_categories():
+    """
+    Returns the prewarmed category list, waiting on the in-flight query if needed.
+    A failed load is dropped so the next rerun queries again.
+    """
+    try:
+        return prewarm_categories().result()
+    except Exception:
+        prewarm_categories.clear()
+        raise
+
+# -------------------------
+# Context Retrieval
+# -------------------------
+@st.cache_data(ttl=300, show_spinner=False)
+def get_similar_chunks(query, category_value, limit=NUM_CHUNKS):
+    """
+    Retrieve the chunks most similar to the query from the Cortex Search Service.
+    Results are memoized for 5 minutes per (query, category_value, limit).
+
+    Args:
+        query (str): The question to retrieve context for.
+        category_value (str): Category filter, or "ALL".
+        limit (int): Number of chunks to return.
+
+    Returns:
+        list[dict]: The retrieved chunks, keyed by column name.
+    """
+    filter_obj = {"@eq": {"category": category_value}} if category_value != "ALL" else None
+    response = get_search_service().search(
+        query=query,
+        columns=COLUMNS,
+        filter=filter_obj,
+        limit=limit
+    )
+    return response.results
+
+def batch_get_similar_chunks(queries, category_value, limit=NUM_CHUNKS):
+    """
+    Retrieve context for many queries in a single round trip using CORTEX_SEARCH_BATCH.
+
+    Args:
+        queries (list[str]): The questions to retrieve context for.
+        category_value (str): Category filter, or "ALL".
+        limit (int): Number of chunks to return per query.
+
+    Returns:
+        dict: Maps each query to its list of retrieved chunks.
+    """
+    filter_json = json.dumps({"@eq": {"category": category_value}}) if category_value != "ALL" else None
+    values = ", ".join(["(?, ?)"] * len(queries))
+    params = [param for query in queries for param in (query, filter_json)]
+    rows = run_query(f"""
+        WITH query_table AS (
+            SELECT column1 AS query, PARSE_JSON(column2) AS filter
+            FROM VALUES {values}
+        )
+        SELECT q.query AS input_query, r.chunk, r.relative_path, r.category
+        FROM query_table q,
+            LATERAL CORTEX_SEARCH_BATCH(
+                service_name => ?,
+                query => q.query,
+                filter => q.filter,
+                limit => ?
+            ) r
+    """, params=params + [CORTEX_SEARCH_SERVICE_NAME, limit])
+
+    results = {query: [] for query in queries}
+    for row in rows:
+        row = row.as_dict()
+        input_query = row.pop("INPUT_QUERY")
+        results[input_query].append({key.lower(): value for key, value in row.items()})
+    return results
+
+# -------------------------
+# Document Links
+# -------------------------
+@st.cache_data(ttl=600, show_spinner=False)
+def get_presigned_urls(relative_paths):
+    """
+    Returns a presigned URL for each document path, generated in a single query.
+    Cached for 10 minutes per set of paths, so repeat documents are not re-signed.
+    """
+    if not relative_paths:
+        return {}
+    values = ", ".join(["(?)"] * len(relative_paths))
+    rows = run_query(f"""
+        SELECT column1 AS relative_path, GET_PRESIGNED_URL({DOCS_STAGE}, column1, ?) AS url_link
+        FROM VALUES {values}
+    """, params=[PRESIGNED_URL_EXPIRY] + list(relative_paths))
+    return {row.RELATIVE_PATH: row.URL_LINK for row in rows}
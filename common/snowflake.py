@@ -0,0 +1,46 @@
+import threading
+
+import streamlit as st
+from snowflake.snowpark import Session
+from snowflake.snowpark.context import get_active_session
+from snowflake.snowpark.exceptions import SnowparkSessionException
+
+# -------------------------
+# Snowflake Connection
+# -------------------------
+@st.cache_resource
+def get_session():
+    """
+    Returns the Snowpark session shared by every page. Inside Streamlit in Snowflake this is
+    the active session; otherwise a session is created from the [snowflake] secrets.
+    """
+    try:
+        return get_active_session()
+    except SnowparkSessionException:
+        return Session.builder.configs({
+            "account": st.secrets["snowflake"]["account"],
+            "user": st.secrets["snowflake"]["user"],
+            "password": st.secrets["snowflake"]["password"],
+            "warehouse": st.secrets["snowflake"]["warehouse"],
+            "database": st.secrets["snowflake"]["database"],
+            "schema": st.secrets["snowflake"]["schema"],
+            "role": st.secrets["snowflake"]["role"],
+            # Keep the cached session alive through idle periods instead of re-authenticating
+            "client_session_keep_alive": True,
+            "client_session_keep_alive_heartbeat_frequency": 900,
+            "client_prefetch_threads": 4,
+            "network_timeout": 60
+        }).create()
+
+
+# Snowpark 1.20 runs every statement on the session's single cursor, so threads sharing
+# the session (test workers, background prefetches) must take turns issuing statements.
+_session_lock = threading.Lock()
+
+def run_query(query, params=None):
+    """
+    Runs a SQL statement on the shared session and returns the collected rows.
+    Statements from concurrent threads are serialized so their results are not interleaved.
+    """
+    with _session_lock:
+        return get_session().sql(query, params=params).collect()
@@ -15,6 +15,9 @@ connection_params = {
     "database": os.getenv("SNOWFLAKE_DATABASE"),
     "schema": os.getenv("SNOWFLAKE_SCHEMA"),
     "warehouse": os.getenv("SNOWFLAKE_WAREHOUSE"),
+    "client_session_keep_alive": True,
+    "client_session_keep_alive_heartbeat_frequency": 900,
+    "network_timeout": 60,
 }
 
 try:
@@ -10,7 +10,10 @@ connection_params = {
     "warehouse": "LLMOPS_WH_M",
     "database": "IRS_PUBS_CORTEX_SEARCH_DOCS",
     "schema": "DATA",
-    "role": "ACCOUNTADMIN"
+    "role": "ACCOUNTADMIN",
+    "client_session_keep_alive": True,
+    "client_session_keep_alive_heartbeat_frequency": 900,
+    "network_timeout": 60
 }
 
 # Create session